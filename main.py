@@ -1,22 +1,29 @@
 import asyncio
 import os
 import re
-import json
+import shutil
 import logging
-import hashlib
+import mimetypes
+import functools
+import random
+import time
+import base64
+import secrets
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 from enum import Enum
 from pathlib import Path
 
-import aiofiles
+import aiosqlite
+import orjson
 from telethon import TelegramClient, events, Button
 from telethon.tl import functions, types
 from telethon.tl.functions.stories import GetStoriesByIDRequest
-from telethon.tl.types import StoryItem, User, Channel
-from telethon.errors import FloodWaitError
+from telethon.tl.types import StoryItem, User, Channel, DocumentAttributeVideo, DocumentAttributeAudio
+from telethon.errors import FloodWaitError, MessageNotModifiedError
+from telethon.extensions import markdown
 from dataclasses import dataclass, field
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 import aiohttp
@@ -31,6 +38,7 @@ class Config:
     
     # Database paths
     DATA_DIR = Path("data")
+    BOT_DB = DATA_DIR / "bot.db"
     USERS_DB = DATA_DIR / "users.json"
     SUBSCRIPTIONS_DB = DATA_DIR / "subscriptions.json"
     CODES_DB = DATA_DIR / "codes.json"
@@ -48,13 +56,25 @@ class Config:
     FREE_CONCURRENT = 1
     PREMIUM_CONCURRENT = 3
     ULTRA_CONCURRENT = 10
+    SESSION_CONCURRENCY = 8  # MTProto calls in flight per session
+    GLOBAL_DOWNLOAD_CONCURRENCY = 32
+    FLOOD_RETRIES = 5
+    NOTIFY_CONCURRENCY = 30
+    DOWNLOAD_CHUNK_SIZE = 512 * 1024  # largest chunk Telegram serves per request
+    PROGRESS_EDIT_INTERVAL = 2  # seconds between progress message edits
     
     # Developer settings
-    DEVELOPER_IDS = [123456789]  # Add your Telegram ID
+    DEVELOPER_IDS = frozenset({123456789})  # Add your Telegram ID
     LOG_CHANNEL = -1001234567890  # Your private log channel
     
     # Cache settings
     CACHE_DURATION = timedelta(hours=24)
+    STORIES_CACHE_DURATION = timedelta(minutes=5)
+    DB_CACHE_TTL = 60  # seconds
+    DB_CACHE_SIZE = 10_000
+    DB_FLUSH_INTERVAL = 2  # seconds
+    ENTITY_CACHE_TTL = 3600  # seconds
+    ENTITY_CACHE_SIZE = 5_000  # per session
     
     # Image for welcome message
     WELCOME_IMAGE = "https://i.imgur.com/a2THbEa_d.webp?maxwidth=760&fidelity=grand"
@@ -76,10 +96,10 @@ class UserData:
     user_id: int
     username: str
     subscription_tier: SubscriptionTier = SubscriptionTier.FREE
-    subscription_ends: Optional[datetime] = None
+    subscription_ends: Optional[int] = None  # unix timestamp
     daily_downloads: int = 0
     total_downloads: int = 0
-    last_reset: datetime = field(default_factory=datetime.now)
+    last_reset: int = field(default_factory=lambda: int(time.time()))
     followed_accounts: List[str] = field(default_factory=list)
     settings: Dict = field(default_factory=lambda: {"silent_mode": False, "quality": "best"})
 
@@ -90,8 +110,8 @@ class SubscriptionCode:
     duration: int  # in days
     max_uses: int
     used_count: int = 0
-    created_at: datetime = field(default_factory=datetime.now)
-    expires_at: Optional[datetime] = None
+    created_at: int = field(default_factory=lambda: int(time.time()))
+    expires_at: Optional[int] = None
 
 @dataclass
 class DownloadTask:
@@ -102,73 +122,356 @@ class DownloadTask:
     progress: float = 0.0
     started_at: datetime = field(default_factory=datetime.now)
 
+# ==================== TIER LIMITS ====================
+DAILY_LIMITS = {
+    SubscriptionTier.FREE: Config.FREE_DAILY_LIMIT,
+    SubscriptionTier.PREMIUM: Config.PREMIUM_DAILY_LIMIT,
+    SubscriptionTier.ULTRA: float('inf')
+}
+
+CONCURRENT_LIMITS = {
+    SubscriptionTier.FREE: Config.FREE_CONCURRENT,
+    SubscriptionTier.PREMIUM: Config.PREMIUM_CONCURRENT,
+    SubscriptionTier.ULTRA: Config.ULTRA_CONCURRENT
+}
+
+SPEED_LABELS = {
+    SubscriptionTier.FREE: 'Normal',
+    SubscriptionTier.PREMIUM: 'Fast',
+    SubscriptionTier.ULTRA: 'Ultra Fast'
+}
+
+FEATURES = {
+    SubscriptionTier.FREE: "• Single story downloads\n• Story previews",
+    SubscriptionTier.PREMIUM: "• Batch downloads\n• Story alerts\n• Priority support",
+    SubscriptionTier.ULTRA: "• One-click download all\n• Full alerts system\n• Best quality\n• No restrictions"
+}
+
 # ==================== DATABASE MANAGER ====================
 class DatabaseManager:
+    _USER_COLUMNS = (
+        "user_id, username, tier, subscription_ends, daily_downloads, "
+        "total_downloads, last_reset, followed_accounts, settings"
+    )
+    _USER_UPSERT = f"INSERT OR REPLACE INTO users ({_USER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    
     def __init__(self):
         self.data_dir = Config.DATA_DIR
         self.data_dir.mkdir(exist_ok=True)
-        
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._conn_lock = asyncio.Lock()
+        self._user_cache: OrderedDict[int, Tuple[float, UserData]] = OrderedDict()
+        self._code_cache: OrderedDict[str, Tuple[float, SubscriptionCode]] = OrderedDict()
+        self._dirty_users: Dict[int, UserData] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._json_counts: Dict[Path, Tuple[Optional[float], int]] = {}
+        # Bounds of the current local day, refreshed when `now` leaves them
+        self._day_start = 0
+        self._next_midnight = 0
+        # Aggregates kept up to date at each event instead of scanning users
+        self.stats = dict.fromkeys(
+            ('total_users', 'free', 'premium', 'ultra', 'total_downloads', 'today_downloads'), 0
+        )
+    
+    @staticmethod
+    def _cache_get(cache: OrderedDict, key, ttl: Optional[float] = Config.DB_CACHE_TTL):
+        entry = cache.get(key)
+        if entry and (ttl is None or time.monotonic() - entry[0] < ttl):
+            cache.move_to_end(key)
+            return entry[1]
+        return None
+    
+    @staticmethod
+    def _cache_put(cache: OrderedDict, key, value):
+        cache[key] = (time.monotonic(), value)
+        cache.move_to_end(key)
+        if len(cache) > Config.DB_CACHE_SIZE:
+            cache.popitem(last=False)
+    
+    async def connect(self) -> aiosqlite.Connection:
+        async with self._conn_lock:
+            if self._conn is None:
+                conn = await aiosqlite.connect(Config.BOT_DB)
+                await conn.execute("PRAGMA journal_mode=WAL")
+                await conn.execute("PRAGMA synchronous=NORMAL")
+                self._conn = conn
+                await self.create_tables()
+                await self.migrate_json()
+                self._flush_task = asyncio.create_task(self._flusher())
+        return self._conn
+    
+    async def close(self):
+        if self._flush_task is not None:
+            # Let an interrupted flush put its batch back before the final one
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self._conn is not None:
+            await self.flush()
+            await self._conn.close()
+            self._conn = None
+    
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(Config.DB_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Failed to flush users: {e}")
+    
+    async def flush(self):
+        """Write all users changed since the last flush in one batch"""
+        if not self._dirty_users or self._conn is None:
+            return
+        dirty, self._dirty_users = self._dirty_users, {}
+        try:
+            await self._conn.executemany(
+                self._USER_UPSERT,
+                [self._user_row(user_data) for user_data in dirty.values()]
+            )
+            await self._conn.commit()
+        except BaseException:
+            # Keep the batch for the next flush unless it was superseded meanwhile
+            for user_id, user_data in dirty.items():
+                self._dirty_users.setdefault(user_id, user_data)
+            raise
+    
+    async def create_tables(self):
+        conn = self._conn
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT NOT NULL,
+                tier TEXT NOT NULL DEFAULT 'free',
+                subscription_ends INTEGER,
+                daily_downloads INTEGER NOT NULL DEFAULT 0,
+                total_downloads INTEGER NOT NULL DEFAULT 0,
+                last_reset INTEGER NOT NULL,
+                followed_accounts TEXT NOT NULL DEFAULT '[]',
+                settings TEXT NOT NULL DEFAULT '{}'
+            )
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS users_tier ON users (tier)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS users_last_reset ON users (last_reset)")
+        await conn.execute("CREATE INDEX IF NOT EXISTS users_subscription_ends ON users (subscription_ends)")
+        await conn.execute("CREATE TABLE IF NOT EXISTS codes (code TEXT PRIMARY KEY, json TEXT NOT NULL)")
+        await conn.commit()
+    
+    async def migrate_json(self):
+        """One-shot import of the legacy users.json/codes.json files"""
+        for path, table in ((Config.USERS_DB, "users"), (Config.CODES_DB, "codes")):
+            if not path.exists():
+                continue
+            data = await self.load_json(path)
+            if table == "users":
+                await self._conn.executemany(
+                    self._USER_UPSERT.replace("OR REPLACE", "OR IGNORE"),
+                    [self._user_row(self._user_from_dict(value)) for value in data.values()]
+                )
+            else:
+                await self._conn.executemany(
+                    "INSERT OR IGNORE INTO codes VALUES (?, ?)",
+                    [(key, orjson.dumps(value, default=str).decode()) for key, value in data.items()]
+                )
+            await self._conn.commit()
+            path.rename(path.with_suffix(".json.migrated"))
+            logging.info(f"Migrated {len(data)} records from {path} into {table}")
+    
     async def load_json(self, path: Path) -> dict:
         if not path.exists():
             return {}
-        async with aiofiles.open(path, 'r') as f:
-            return json.loads(await f.read())
+        return orjson.loads(await asyncio.to_thread(path.read_bytes))
+    
+    @staticmethod
+    def _timestamp(value) -> Optional[int]:
+        """Unix timestamp of a stored time, accepting legacy ISO strings"""
+        if value is None or isinstance(value, int):
+            return value
+        return int(datetime.fromisoformat(value).timestamp())
+    
+    def day_start(self, now: int) -> int:
+        """Unix timestamp of local midnight on the day of `now`"""
+        if not self._day_start <= now < self._next_midnight:
+            midnight = datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+            self._day_start = int(midnight.timestamp())
+            self._next_midnight = int((midnight + timedelta(days=1)).timestamp())
+        return self._day_start
+    
+    async def load_stats(self):
+        """Initialize the aggregate counters from SQL aggregates"""
+        conn = await self.connect()
+        await self.flush()
+        stats = dict.fromkeys(self.stats, 0)
+        today_start = self.day_start(int(time.time()))
+        
+        async with conn.execute("SELECT tier, COUNT(*), SUM(total_downloads) FROM users GROUP BY tier") as cursor:
+            async for tier, count, downloads in cursor:
+                stats[tier] = count
+                stats['total_users'] += count
+                stats['total_downloads'] += downloads or 0
+        async with conn.execute(
+            "SELECT COALESCE(SUM(daily_downloads), 0) FROM users WHERE last_reset >= ?", (today_start,)
+        ) as cursor:
+            (stats['today_downloads'],) = await cursor.fetchone()
+        
+        self.stats.update(stats)
+    
+    async def reset_daily_downloads(self, now: int) -> int:
+        """Reset the daily counters of users last reset before today"""
+        conn = await self.connect()
+        await self.flush()
+        cursor = await conn.execute(
+            "UPDATE users SET daily_downloads = 0, last_reset = ? WHERE last_reset < ?",
+            (now, self.day_start(now))
+        )
+        await conn.commit()
+        if cursor.rowcount:
+            self._user_cache.clear()
+        return cursor.rowcount
     
-    async def save_json(self, path: Path, data: dict):
-        async with aiofiles.open(path, 'w') as f:
-            await f.write(json.dumps(data, default=str, indent=2))
+    async def expire_subscriptions(self, now: int) -> List[int]:
+        """Downgrade expired subscriptions to free, returning the affected user IDs"""
+        conn = await self.connect()
+        await self.flush()
+        async with conn.execute("SELECT user_id FROM users WHERE subscription_ends < ?", (now,)) as cursor:
+            expired = [user_id async for (user_id,) in cursor]
+        if expired:
+            await conn.execute(
+                "UPDATE users SET tier = 'free', subscription_ends = NULL WHERE subscription_ends < ?",
+                (now,)
+            )
+            await conn.commit()
+            self._user_cache.clear()
+        return expired
+    
+    def record_new_user(self, tier: SubscriptionTier = SubscriptionTier.FREE):
+        self.stats['total_users'] += 1
+        self.stats[tier.value] += 1
+    
+    def record_tier_change(self, old: str, new: str):
+        self.stats[old] -= 1
+        self.stats[new] += 1
+    
+    def record_download(self):
+        self.stats['total_downloads'] += 1
+        self.stats['today_downloads'] += 1
+    
+    async def count_json(self, path: Path) -> int:
+        """Number of records in a JSON file, re-read only when the file changes"""
+        mtime = path.stat().st_mtime if path.exists() else None
+        cached = self._json_counts.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        
+        count = len(await self.load_json(path))
+        self._json_counts[path] = (mtime, count)
+        return count
+    
+    async def count_codes(self) -> int:
+        conn = await self.connect()
+        async with conn.execute("SELECT COUNT(*) FROM codes") as cursor:
+            (count,) = await cursor.fetchone()
+        return count
     
     async def get_user(self, user_id: int) -> Optional[UserData]:
-        data = await self.load_json(Config.USERS_DB)
-        user_data = data.get(str(user_id))
-        if user_data:
-            user_data['subscription_tier'] = SubscriptionTier(user_data['subscription_tier'])
-            if user_data.get('subscription_ends'):
-                user_data['subscription_ends'] = datetime.fromisoformat(user_data['subscription_ends'])
-            user_data['last_reset'] = datetime.fromisoformat(user_data['last_reset'])
-            return UserData(**user_data)
+        if user_id in self._dirty_users:
+            return self._dirty_users[user_id]
+        # Users are only written through this cache, so entries never go stale
+        cached = self._cache_get(self._user_cache, user_id, ttl=None)
+        if cached:
+            return cached
+        
+        conn = await self.connect()
+        async with conn.execute(f"SELECT {self._USER_COLUMNS} FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            user = self._user_from_row(row)
+            self._cache_put(self._user_cache, user_id, user)
+            return user
         return None
     
+    @staticmethod
+    def _user_row(user_data: UserData) -> tuple:
+        return (
+            user_data.user_id,
+            user_data.username,
+            user_data.subscription_tier.value,
+            user_data.subscription_ends,
+            user_data.daily_downloads,
+            user_data.total_downloads,
+            user_data.last_reset,
+            orjson.dumps(user_data.followed_accounts).decode(),
+            orjson.dumps(user_data.settings).decode()
+        )
+    
+    @staticmethod
+    def _user_from_row(row) -> UserData:
+        user_id, username, tier, ends, daily, total, last_reset, followed, settings = row
+        return UserData(
+            user_id=user_id,
+            username=username,
+            subscription_tier=SubscriptionTier(tier),
+            subscription_ends=ends,
+            daily_downloads=daily,
+            total_downloads=total,
+            last_reset=last_reset,
+            followed_accounts=orjson.loads(followed),
+            settings=orjson.loads(settings)
+        )
+    
+    @classmethod
+    def _user_from_dict(cls, user_data: dict) -> UserData:
+        """Build a user from a legacy JSON record"""
+        user_data = dict(user_data)
+        user_data['subscription_tier'] = SubscriptionTier(user_data['subscription_tier'])
+        user_data['subscription_ends'] = cls._timestamp(user_data.get('subscription_ends'))
+        user_data['last_reset'] = cls._timestamp(user_data['last_reset'])
+        return UserData(**user_data)
+    
     async def save_user(self, user_data: UserData):
-        data = await self.load_json(Config.USERS_DB)
-        user_dict = {
-            'user_id': user_data.user_id,
-            'username': user_data.username,
-            'subscription_tier': user_data.subscription_tier.value,
-            'subscription_ends': user_data.subscription_ends.isoformat() if user_data.subscription_ends else None,
-            'daily_downloads': user_data.daily_downloads,
-            'total_downloads': user_data.total_downloads,
-            'last_reset': user_data.last_reset.isoformat(),
-            'followed_accounts': user_data.followed_accounts,
-            'settings': user_data.settings
-        }
-        data[str(user_data.user_id)] = user_dict
-        await self.save_json(Config.USERS_DB, data)
+        """Queue the user for the next batched flush"""
+        await self.connect()
+        self._cache_put(self._user_cache, user_data.user_id, user_data)
+        self._dirty_users[user_data.user_id] = user_data
     
     async def get_code(self, code: str) -> Optional[SubscriptionCode]:
-        data = await self.load_json(Config.CODES_DB)
-        code_data = data.get(code)
-        if code_data:
+        cached = self._cache_get(self._code_cache, code)
+        if cached:
+            return cached
+        
+        conn = await self.connect()
+        async with conn.execute("SELECT json FROM codes WHERE code = ?", (code,)) as cursor:
+            row = await cursor.fetchone()
+        if row:
+            code_data = orjson.loads(row[0])
             code_data['tier'] = SubscriptionTier(code_data['tier'])
-            code_data['created_at'] = datetime.fromisoformat(code_data['created_at'])
-            if code_data.get('expires_at'):
-                code_data['expires_at'] = datetime.fromisoformat(code_data['expires_at'])
-            return SubscriptionCode(**code_data)
+            code_data['created_at'] = self._timestamp(code_data['created_at'])
+            code_data['expires_at'] = self._timestamp(code_data.get('expires_at'))
+            code_obj = SubscriptionCode(**code_data)
+            self._cache_put(self._code_cache, code, code_obj)
+            return code_obj
         return None
     
     async def save_code(self, code: SubscriptionCode):
-        data = await self.load_json(Config.CODES_DB)
+        self._cache_put(self._code_cache, code.code, code)
+        conn = await self.connect()
         code_dict = {
             'code': code.code,
             'tier': code.tier.value,
             'duration': code.duration,
             'max_uses': code.max_uses,
             'used_count': code.used_count,
-            'created_at': code.created_at.isoformat(),
-            'expires_at': code.expires_at.isoformat() if code.expires_at else None
+            'created_at': code.created_at,
+            'expires_at': code.expires_at
         }
-        data[code.code] = code_dict
-        await self.save_json(Config.CODES_DB, data)
+        await conn.execute(
+            "INSERT OR REPLACE INTO codes VALUES (?, ?)",
+            (code.code, orjson.dumps(code_dict).decode())
+        )
+        await conn.commit()
 
 # ==================== SUBSCRIPTION MANAGER ====================
 class SubscriptionManager:
@@ -176,21 +479,28 @@ class SubscriptionManager:
         self.db = db
         self.scheduler = AsyncIOScheduler()
     
-    async def check_subscription(self, user_id: int) -> Tuple[SubscriptionTier, Optional[datetime]]:
+    async def check_subscription(self, user_id: int) -> Tuple[SubscriptionTier, Optional[int]]:
         user_data = await self.db.get_user(user_id)
         if not user_data:
             return SubscriptionTier.FREE, None
         
+        dirty = False
+        now = int(time.time())
+        
         # Check if subscription expired
-        if user_data.subscription_ends and datetime.now() > user_data.subscription_ends:
+        if user_data.subscription_ends and now > user_data.subscription_ends:
+            self.db.record_tier_change(user_data.subscription_tier.value, SubscriptionTier.FREE.value)
             user_data.subscription_tier = SubscriptionTier.FREE
             user_data.subscription_ends = None
-            await self.db.save_user(user_data)
+            dirty = True
         
         # Reset daily downloads
-        if (datetime.now() - user_data.last_reset).days >= 1:
+        if user_data.last_reset < self.db.day_start(now):
             user_data.daily_downloads = 0
-            user_data.last_reset = datetime.now()
+            user_data.last_reset = now
+            dirty = True
+        
+        if dirty:
             await self.db.save_user(user_data)
         
         return user_data.subscription_tier, user_data.subscription_ends
@@ -200,7 +510,7 @@ class SubscriptionManager:
         if not code_data:
             return False, "❌ Invalid code"
         
-        if code_data.expires_at and datetime.now() > code_data.expires_at:
+        if code_data.expires_at and time.time() > code_data.expires_at:
             return False, "❌ Code has expired"
         
         if code_data.used_count >= code_data.max_uses:
@@ -211,8 +521,9 @@ class SubscriptionManager:
             return False, "❌ User not found"
         
         # Update user subscription
+        self.db.record_tier_change(user_data.subscription_tier.value, code_data.tier.value)
         user_data.subscription_tier = code_data.tier
-        user_data.subscription_ends = datetime.now() + timedelta(days=code_data.duration)
+        user_data.subscription_ends = int(time.time()) + code_data.duration * 86400
         
         # Update code usage
         code_data.used_count += 1
@@ -221,12 +532,20 @@ class SubscriptionManager:
         
         return True, f"✅ {code_data.tier.value.capitalize()} subscription activated for {code_data.duration} days!"
     
+    async def get_remaining_downloads(self, user_id: int):
+        user_data = await self.db.get_user(user_id)
+        if not user_data:
+            return DAILY_LIMITS[SubscriptionTier.FREE]
+        if user_data.subscription_tier == SubscriptionTier.ULTRA:
+            return '∞'
+        return max(DAILY_LIMITS[user_data.subscription_tier] - user_data.daily_downloads, 0)
+    
     async def create_code(self, tier: SubscriptionTier, duration_days: int, max_uses: int = 1, expires_in_days: Optional[int] = None) -> str:
-        code = hashlib.sha256(f"{tier}{duration_days}{datetime.now()}".encode()).hexdigest()[:12].upper()
+        code = base64.b32encode(secrets.token_bytes(8)).decode().rstrip('=')[:12]
         
         expires_at = None
         if expires_in_days:
-            expires_at = datetime.now() + timedelta(days=expires_in_days)
+            expires_at = int(time.time()) + expires_in_days * 86400
         
         code_data = SubscriptionCode(
             code=code,
@@ -243,16 +562,22 @@ class SubscriptionManager:
 class SessionManager:
     def __init__(self):
         self.sessions: Dict[str, TelegramClient] = {}
-        self.active_sessions: List[str] = []
-        self.session_rotation_index = 0
+        self.active_sessions: deque[str] = deque()
+        self._rotation_lock = asyncio.Lock()
+        self._limits: Dict[TelegramClient, asyncio.BoundedSemaphore] = {}
+        # Resolved entities per session, access hashes differ between accounts
+        self._entities: Dict[TelegramClient, OrderedDict[str, Tuple[float, Any]]] = {}
     
     async def add_session(self, session_string: str, name: str) -> bool:
         try:
             client = TelegramClient(StringSession(session_string), Config.API_ID, Config.API_HASH)
             await client.connect()
             if await client.is_user_authorized():
-                self.sessions[name] = client
-                self.active_sessions.append(name)
+                async with self._rotation_lock:
+                    self.sessions[name] = client
+                    self.active_sessions.append(name)
+                    self._limits[client] = asyncio.BoundedSemaphore(Config.SESSION_CONCURRENCY)
+                    self._entities[client] = OrderedDict()
                 return True
             return False
         except Exception as e:
@@ -260,168 +585,400 @@ class SessionManager:
             return False
     
     async def get_next_client(self) -> Optional[TelegramClient]:
-        if not self.active_sessions:
-            return None
-        
-        self.session_rotation_index = (self.session_rotation_index + 1) % len(self.active_sessions)
-        session_name = self.active_sessions[self.session_rotation_index]
-        return self.sessions.get(session_name)
+        async with self._rotation_lock:
+            if not self.active_sessions:
+                return None
+            
+            self.active_sessions.rotate(-1)
+            return self.sessions.get(self.active_sessions[0])
+    
+    def limit(self, client: TelegramClient) -> asyncio.BoundedSemaphore:
+        """Semaphore bounding concurrent API calls made through a session"""
+        semaphore = self._limits.get(client)
+        if semaphore is None:
+            # The session was removed mid-call, don't register it again
+            return asyncio.BoundedSemaphore(Config.SESSION_CONCURRENCY)
+        return semaphore
+    
+    def entities(self, client: TelegramClient) -> OrderedDict:
+        """Entity cache of a session, kept in insertion order so the oldest entries come first"""
+        cache = self._entities.get(client)
+        if cache is None:
+            # The session was removed mid-call, cache nothing for it
+            return OrderedDict()
+        return cache
     
     async def remove_session(self, name: str) -> bool:
         if name in self.sessions:
-            await self.sessions[name].disconnect()
-            del self.sessions[name]
-            if name in self.active_sessions:
-                self.active_sessions.remove(name)
+            # Take it out of rotation before the disconnect yields
+            async with self._rotation_lock:
+                if name in self.active_sessions:
+                    self.active_sessions.remove(name)
+            client = self.sessions.pop(name)
+            self._limits.pop(client, None)
+            self._entities.pop(client, None)
+            await client.disconnect()
             return True
         return False
 
 # ==================== STORY DOWNLOADER ====================
+STORY_URL_RE = re.compile(r"https?://t\.me/([a-zA-Z0-9_]+)/(?:s/)?(\d+)")
+
 class StoryDownloader:
-    def __init__(self, session_manager: SessionManager, db: DatabaseManager):
+    def __init__(self, session_manager: SessionManager, db: DatabaseManager, sub_manager: SubscriptionManager):
         self.session_manager = session_manager
         self.db = db
-        self.cache = {}
+        self.sub_manager = sub_manager
+        # Kept in insertion order so expired entries are always at the front
+        self.cache: OrderedDict[str, dict] = OrderedDict()
         self.download_tasks: Dict[str, DownloadTask] = {}
+        self._download_slots = asyncio.Semaphore(Config.GLOBAL_DOWNLOAD_CONCURRENCY)
+        self._inflight: Dict[Tuple[str, int, str], asyncio.Future] = {}
         
     def parse_story_url(self, url: str) -> Tuple[Optional[str], Optional[int]]:
-        patterns = [
-            r"https?://t\.me/([a-zA-Z0-9_]+)/s/(\d+)",
-            r"https?://t\.me/([a-zA-Z0-9_]+)/(\d+)"
-        ]
-        
-        for pattern in patterns:
-            match = re.match(pattern, url)
-            if match:
-                return match.group(1), int(match.group(2))
+        match = STORY_URL_RE.match(url)
+        if match:
+            return match.group(1), int(match.group(2))
         return None, None
     
+    async def _entity(self, client: TelegramClient, username: str):
+        cache = self.session_manager.entities(client)
+        key = username.lower()
+        cached = cache.get(key)
+        if cached and time.monotonic() - cached[0] < Config.ENTITY_CACHE_TTL:
+            return cached[1]
+        
+        async with self.session_manager.limit(client):
+            entity = await client.get_entity(username)
+        
+        now = time.monotonic()
+        cache[key] = (now, entity)
+        cache.move_to_end(key)
+        # Evict expired entries from the front, then bound the size
+        while cache and now - next(iter(cache.values()))[0] >= Config.ENTITY_CACHE_TTL:
+            cache.popitem(last=False)
+        if len(cache) > Config.ENTITY_CACHE_SIZE:
+            cache.popitem(last=False)
+        return entity
+    
+    async def _call(self, client: TelegramClient, make_call):
+        """Run an API call under the session limit, retrying on FloodWait"""
+        for attempt in range(Config.FLOOD_RETRIES):
+            try:
+                async with self.session_manager.limit(client):
+                    return await make_call()
+            except FloodWaitError as e:
+                if attempt == Config.FLOOD_RETRIES - 1:
+                    raise
+                await asyncio.sleep(e.seconds + random.uniform(0, 1))
+    
     async def fetch_stories(self, username: str) -> List[Tuple[int, StoryItem]]:
         client = await self.session_manager.get_next_client()
         if not client:
             raise Exception("No active sessions available")
         
         try:
-            entity = await client.get_entity(username)
+            entity = await self._entity(client, username)
             stories = []
             
             # Get user's stories
-            async for story in client.iter_stories(entity):
-                stories.append((story.id, story))
+            async with self.session_manager.limit(client):
+                async for story in client.iter_stories(entity):
+                    stories.append((story.id, story))
             
+            key = username.lower()
+            now = datetime.now()
+            self.cache[key] = {
+                'timestamp': now,
+                'stories': dict(stories)
+            }
+            self.cache.move_to_end(key)
+            self.prune_cache(now)
             return stories
         except Exception as e:
             logging.error(f"Error fetching stories from {username}: {e}")
             return []
     
+    def prune_cache(self, now: datetime):
+        """Drop listings too old for get_story to use, oldest first"""
+        cutoff = now - Config.STORIES_CACHE_DURATION
+        while self.cache:
+            key = next(iter(self.cache))
+            if self.cache[key]['timestamp'] >= cutoff:
+                break
+            del self.cache[key]
+    
+    async def get_story(self, username: str, story_id: int) -> Optional[StoryItem]:
+        """Get a single story, from the last listing if it is still fresh"""
+        cached = self.cache.get(username.lower())
+        if cached and datetime.now() - cached['timestamp'] < Config.STORIES_CACHE_DURATION:
+            story = cached['stories'].get(story_id)
+            if story:
+                return story
+        
+        client = await self.session_manager.get_next_client()
+        if not client:
+            raise Exception("No active sessions available")
+        
+        entity = await self._entity(client, username)
+        async with self.session_manager.limit(client):
+            result = await client(GetStoriesByIDRequest(peer=entity, id=[story_id]))
+        return result.stories[0] if result.stories else None
+    
     async def download_story(self, user_id: int, username: str, story_id: int, quality: str = "best") -> Optional[Path]:
         user_data = await self.db.get_user(user_id)
         if not user_data:
             return None
         
         # Check download limits
-        tier, _ = await SubscriptionManager(self.db).check_subscription(user_id)
+        tier, _ = await self.sub_manager.check_subscription(user_id)
         
-        limits = {
-            SubscriptionTier.FREE: Config.FREE_DAILY_LIMIT,
-            SubscriptionTier.PREMIUM: Config.PREMIUM_DAILY_LIMIT,
-            SubscriptionTier.ULTRA: float('inf')
-        }
-        
-        if user_data.daily_downloads >= limits[tier]:
+        if user_data.daily_downloads >= DAILY_LIMITS[tier]:
             raise Exception("Daily download limit reached")
         
-        # Perform download
-        client = await self.session_manager.get_next_client()
-        if not client:
-            raise Exception("No active sessions available")
+        download_dir = Path(f"downloads/{user_id}")
+        download_dir.mkdir(parents=True, exist_ok=True)
+        
+        key = (username.lower(), story_id, quality)
         
         try:
-            entity = await client.get_entity(username)
-            result = await client(GetStoriesByIDRequest(
+            inflight = self._inflight.get(key)
+            if inflight:
+                # Someone is already downloading this story, share their file
+                source = await asyncio.shield(inflight)
+                if not source:
+                    return None
+                file_path = download_dir / f"{source.stem}_{time.monotonic_ns()}{source.suffix}"
+                try:
+                    os.link(source, file_path)
+                except OSError:
+                    await asyncio.to_thread(shutil.copyfile, source, file_path)
+            else:
+                future = asyncio.get_running_loop().create_future()
+                self._inflight[key] = future
+                try:
+                    file_path = await self._fetch_story_media(username, story_id, download_dir)
+                    future.set_result(file_path)
+                except BaseException:
+                    future.set_result(None)
+                    raise
+                finally:
+                    del self._inflight[key]
+            
+            # Update user stats on the current record, the download may have outlived ours
+            user_data = await self.db.get_user(user_id)
+            user_data.daily_downloads += 1
+            user_data.total_downloads += 1
+            await self.db.save_user(user_data)
+            self.db.record_download()
+            
+            return file_path
+            
+        except Exception as e:
+            logging.error(f"Error downloading story: {e}")
+            return None
+    
+    async def _fetch_story_media(self, username: str, story_id: int, download_dir: Path) -> Path:
+        async with self._download_slots:
+            client = await self.session_manager.get_next_client()
+            if not client:
+                raise Exception("No active sessions available")
+            
+            entity = await self._entity(client, username)
+            result = await self._call(client, lambda: client(GetStoriesByIDRequest(
                 peer=entity,
                 id=[story_id]
-            ))
+            )))
             
             if not result.stories:
                 raise Exception("Story not found")
             
             story = result.stories[0]
             
-            # Determine download path
-            download_dir = Path(f"downloads/{user_id}")
-            download_dir.mkdir(parents=True, exist_ok=True)
-            
             filename = f"{username}_{story_id}_{int(datetime.now().timestamp())}"
             
             if hasattr(story.media, 'photo'):
                 filename += ".jpg"
                 file_path = download_dir / filename
-                await client.download_media(story.media.photo, file=file_path)
+                await self._call(client, lambda: client.download_media(story.media.photo, file=file_path))
             elif hasattr(story.media, 'document'):
                 # Determine file extension
                 doc = story.media.document
-                mime_type = doc.mime_type or "bin"
-                ext = mime_type.split('/')[-1]
-                if ext == 'octet-stream':
-                    ext = 'mp4' if any(attr in doc.attributes for attr in ['Video', 'Audio']) else 'bin'
-                filename += f".{ext}"
+                ext = None
+                if doc.mime_type and doc.mime_type != 'application/octet-stream':
+                    ext = mimetypes.guess_extension(doc.mime_type)
+                if not ext:
+                    is_media = any(isinstance(attr, (DocumentAttributeVideo, DocumentAttributeAudio)) for attr in doc.attributes)
+                    ext = '.mp4' if is_media else '.bin'
+                filename += ext
                 file_path = download_dir / filename
-                await client.download_media(story.media.document, file=file_path)
+                await self._call(client, lambda: self._stream_to_file(client, story.media.document, file_path))
             else:
                 raise Exception("Unsupported media type")
             
-            # Update user stats
-            user_data.daily_downloads += 1
-            user_data.total_downloads += 1
-            await self.db.save_user(user_data)
-            
             return file_path
-            
-        except FloodWaitError as e:
-            await asyncio.sleep(e.seconds)
-            return await self.download_story(user_id, username, story_id, quality)
-        except Exception as e:
-            logging.error(f"Error downloading story: {e}")
-            return None
+    
+    async def _stream_to_file(self, client: TelegramClient, media, file_path: Path):
+        """Download media chunk by chunk, writing each chunk from a worker thread"""
+        f = await asyncio.to_thread(open, file_path, 'wb')
+        try:
+            async for chunk in client.iter_download(media, request_size=Config.DOWNLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(f.write, chunk)
+        finally:
+            await asyncio.to_thread(f.close)
+
+# ==================== UI TEXTS ====================
+# Static texts are parsed from markdown once and sent with their entities
+UPGRADE_TEXT, UPGRADE_ENTITIES = markdown.parse("""
+💎 **Subscription Plans**
+
+🆓 **FREE TIER**
+• 5 downloads per day
+• Basic speed
+• Single downloads only
+• No alerts
+
+⭐ **PREMIUM TIER** - $9.99/month
+• 50 downloads per day
+• High speed
+• Batch downloads (up to 5)
+• Story alerts
+• Priority support
+
+👑 **ULTRA TIER** - $19.99/month
+• Unlimited downloads
+• Maximum speed
+• One-click download all
+• Unlimited concurrent
+• Full alerts system
+• Best quality
+• No restrictions
+
+To upgrade, contact @admin with your preferred plan.
+""")
+
+PREMIUM_INFO_TEXT, PREMIUM_INFO_ENTITIES = markdown.parse("""
+⭐ **Premium Plan** - $9.99/month
+
+• 50 downloads per day
+• High speed
+• Batch downloads (up to 5)
+• Story alerts
+• Priority support
+
+To upgrade, contact @admin or enter a subscription code.
+""")
+
+HELP_MAIN_TEXT, HELP_MAIN_ENTITIES = markdown.parse("""
+🆘 **Help Center**
+
+Choose a help section:
+/help bot - What the bot does
+/help systems - Free/Premium/Ultra systems
+/help subscription - How subscriptions work
+/help alerts - How alerts work
+/help download - How to download stories
+/help commands - All available commands
+
+Or use buttons below:
+""")
+
+HELP_MAIN_BUTTONS = [
+    [Button.inline("🤖 Bot Info", b"help_bot"),
+     Button.inline("⭐ Systems", b"help_systems")],
+    [Button.inline("💎 Subscription", b"help_subscription"),
+     Button.inline("🔔 Alerts", b"help_alerts")],
+    [Button.inline("📥 Download", b"help_download"),
+     Button.inline("📋 Commands", b"help_commands")]
+]
+
+HELP_BOT_TEXT, HELP_BOT_ENTITIES = markdown.parse("""
+🤖 **StoryDownloader Pro**
+
+A powerful Telegram bot for downloading stories from public Telegram accounts.
+
+**Features:**
+• Download stories as photos/videos
+• Preview before download
+• Multiple quality options
+• Subscription system
+• Story alerts
+• Developer dashboard
+• And much more!
+
+**Privacy:**
+• We don't store your downloaded files
+• We respect Telegram's ToS
+• All downloads are client-side
+""")
+
+# /help <section> -> (text, entities)
+HELP_SECTIONS = {
+    "bot": (HELP_BOT_TEXT, HELP_BOT_ENTITIES),
+    # ... (other help sections)
+}
+
+ACCESS_DENIED = "❌ Access denied."
+
+PANEL_TEXT, PANEL_ENTITIES = markdown.parse("""
+🔧 **Developer Control Panel**
+
+Choose an option:
+""")
+
+PANEL_BUTTONS = [
+    [Button.inline("📊 System Stats", b"admin_stats"),
+     Button.inline("👥 Users", b"admin_users")],
+    [Button.inline("🔑 Generate Code", b"admin_gen_code"),
+     Button.inline("📋 Active Subs", b"admin_subs")],
+    [Button.inline("📡 Sessions", b"admin_sessions"),
+     Button.inline("📨 Broadcast", b"admin_broadcast")],
+    [Button.inline("📜 Logs", b"admin_logs"),
+     Button.inline("⚙️ Settings", b"admin_settings")]
+]
 
 # ==================== BOT UI MANAGER ====================
+PROGRESS_BAR_LENGTH = 20
+PROGRESS_BARS = ["█" * i + "░" * (PROGRESS_BAR_LENGTH - i) for i in range(PROGRESS_BAR_LENGTH + 1)]
+
+SUBSCRIPTION_ICONS = {
+    SubscriptionTier.FREE: "🆓",
+    SubscriptionTier.PREMIUM: "⭐",
+    SubscriptionTier.ULTRA: "👑"
+}
+
 class UIManager:
+    def __init__(self, sub_manager: SubscriptionManager):
+        self.sub_manager = sub_manager
+    
     @staticmethod
-    def create_progress_bar(progress: float, length: int = 20) -> str:
+    def create_progress_bar(progress: float, length: int = PROGRESS_BAR_LENGTH) -> str:
         filled = int(length * progress)
-        bar = "█" * filled + "░" * (length - filled)
+        if length == PROGRESS_BAR_LENGTH:
+            bar = PROGRESS_BARS[filled]
+        else:
+            bar = "█" * filled + "░" * (length - filled)
         return f"[{bar}] {progress*100:.1f}%"
     
     @staticmethod
     def get_subscription_icon(tier: SubscriptionTier) -> str:
-        icons = {
-            SubscriptionTier.FREE: "🆓",
-            SubscriptionTier.PREMIUM: "⭐",
-            SubscriptionTier.ULTRA: "👑"
-        }
-        return icons.get(tier, "❓")
+        return SUBSCRIPTION_ICONS.get(tier, "❓")
     
     @staticmethod
-    async def create_welcome_message(user_id: int, username: str) -> str:
-        db = DatabaseManager()
-        sub_manager = SubscriptionManager(db)
-        
-        tier, ends = await sub_manager.check_subscription(user_id)
-        icon = UIManager.get_subscription_icon(tier)
-        
-        message = f"""
+    @functools.lru_cache(maxsize=64)
+    def render_welcome(tier: SubscriptionTier, remaining, username: str) -> Tuple[str, list]:
+        return markdown.parse(f"""
 🎬 **Welcome to StoryDownloader Pro!** 🚀
 
 👤 **User:** @{username}
-{icon} **Plan:** {tier.value.upper()}
+{UIManager.get_subscription_icon(tier)} **Plan:** {tier.value.upper()}
 
-📥 **Daily Downloads:** {await sub_manager.get_remaining_downloads(user_id)}
-⚡ **Speed:** {await sub_manager.get_download_speed(tier)}
-🔢 **Concurrent:** {await sub_manager.get_concurrent_limit(tier)}
+📥 **Daily Downloads:** {remaining}
+⚡ **Speed:** {SPEED_LABELS[tier]}
+🔢 **Concurrent:** {CONCURRENT_LIMITS[tier]}
 
 ✨ **Features:**
-{await sub_manager.get_features_list(tier)}
+{FEATURES[tier]}
 
 📌 **How to use:**
 1. Send a username (e.g., `@username`)
@@ -429,26 +986,59 @@ class UIManager:
 3. Use buttons to preview and download
 
 💎 **Upgrade your plan for more features!**
-        """
-        return message
+        """)
+    
+    async def create_welcome_message(self, user_id: int, username: str) -> Tuple[str, list]:
+        tier, ends = await self.sub_manager.check_subscription(user_id)
+        remaining = await self.sub_manager.get_remaining_downloads(user_id)
+        return self.render_welcome(tier, remaining, username)
 
 # ==================== MAIN BOT CLASS ====================
+def dev_only(handler):
+    """Restrict a StoryBot handler to Config.DEVELOPER_IDS"""
+    @functools.wraps(handler)
+    async def wrapper(self, event):
+        if event.sender_id not in Config.DEVELOPER_IDS:
+            return await event.reply(ACCESS_DENIED)
+        return await handler(self, event)
+    return wrapper
+
 class StoryBot:
     def __init__(self):
         self.bot = TelegramClient("bot", Config.API_ID, Config.API_HASH)
         self.db = DatabaseManager()
         self.sub_manager = SubscriptionManager(self.db)
         self.session_manager = SessionManager()
-        self.downloader = StoryDownloader(self.session_manager, self.db)
-        self.ui = UIManager()
+        self.downloader = StoryDownloader(self.session_manager, self.db, self.sub_manager)
+        self.ui = UIManager(self.sub_manager)
         self.scheduler = AsyncIOScheduler()
+        self.http = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(limit=64, ttl_dns_cache=300)
+        )
+        self._welcome_media = None
+        self.stats = self.db.stats
         
         # Active downloads tracking
-        self.active_downloads: Dict[int, List[str]] = defaultdict(list)
+        self.active_downloads: Dict[int, int] = defaultdict(int)
+        self.active_download_count = 0
+        self._batch_users: set = set()
         
         # Register event handlers
         self.register_handlers()
     
+    async def close(self):
+        """Release network and database resources"""
+        await self.http.close()
+        await self.db.close()
+    
+    async def fetch_welcome_image(self) -> io.BytesIO:
+        async with self.http.get(Config.WELCOME_IMAGE) as resp:
+            resp.raise_for_status()
+            image = io.BytesIO(await resp.read())
+        image.name = "welcome" + Path(resp.url.path).suffix
+        return image
+    
     def register_handlers(self):
         @self.bot.on(events.NewMessage(pattern='/start'))
         async def start_handler(event):
@@ -491,9 +1081,10 @@ class StoryBot:
         if not user_data:
             user_data = UserData(user_id=user.id, username=user.username or str(user.id))
             await self.db.save_user(user_data)
+            self.db.record_new_user(user_data.subscription_tier)
         
         # Send welcome message with image
-        welcome_text = await self.ui.create_welcome_message(user.id, user.username or str(user.id))
+        welcome_text, welcome_entities = await self.ui.create_welcome_message(user.id, user.username or str(user.id))
         
         buttons = [
             [Button.inline("📥 Download Stories", b"download_help"),
@@ -504,20 +1095,22 @@ class StoryBot:
              Button.inline("👑 Premium", b"premium_info")]
         ]
         
-        # Try to send with image
+        # Try to send with image, reusing the media uploaded on the first /start
         try:
-            await event.reply(
-                file=Config.WELCOME_IMAGE,
+            sent = await event.reply(
+                file=self._welcome_media or await self.fetch_welcome_image(),
                 message=welcome_text,
-                buttons=buttons,
-                parse_mode='md'
+                formatting_entities=welcome_entities,
+                buttons=buttons
             )
+            self._welcome_media = sent.media
         except:
-            # Fallback to text only
+            # Fallback to text only, refetching the image next time in case the cached media went stale
+            self._welcome_media = None
             await event.reply(
                 welcome_text,
-                buttons=buttons,
-                parse_mode='md'
+                formatting_entities=welcome_entities,
+                buttons=buttons
             )
     
     async def handle_message(self, event):
@@ -578,23 +1171,17 @@ class StoryBot:
         # Check subscription status
         tier, ends = await self.sub_manager.check_subscription(user_id)
         
-        # Check concurrent downloads
-        if len(self.active_downloads.get(user_id, [])) >= {
-            SubscriptionTier.FREE: Config.FREE_CONCURRENT,
-            SubscriptionTier.PREMIUM: Config.PREMIUM_CONCURRENT,
-            SubscriptionTier.ULTRA: Config.ULTRA_CONCURRENT
-        }[tier]:
+        # Reserve a download slot within the plan's concurrency limit
+        if not self._start_download(user_id, tier):
             await event.reply("⚠️ You have too many active downloads. Please wait.")
             return
         
-        # Create task ID
-        task_id = f"{user_id}_{username}_{story_id}_{int(datetime.now().timestamp())}"
-        
-        # Send progress message
-        progress_msg = await event.reply(f"⏳ Preparing download...\n{UIManager.create_progress_bar(0)}")
-        
-        # Add to active downloads
-        self.active_downloads[user_id].append(task_id)
+        try:
+            # Send progress message
+            progress_msg = await event.reply(f"⏳ Preparing download...\n{UIManager.create_progress_bar(0)}")
+        except BaseException:
+            self._finish_download(user_id)
+            raise
         
         try:
             # Download the story
@@ -620,21 +1207,118 @@ class StoryBot:
             
         finally:
             # Remove from active downloads
-            if user_id in self.active_downloads:
-                self.active_downloads[user_id].remove(task_id)
+            self._finish_download(user_id)
+    
+    async def download_all_stories(self, event, username: str):
+        """Download all stories of an account concurrently, up to the plan's limits"""
+        user_id = event.sender_id
+        
+        tier, ends = await self.sub_manager.check_subscription(user_id)
+        if tier == SubscriptionTier.FREE:
+            await event.answer("⭐ Batch downloads require Premium or Ultra.", alert=True)
+            return
+        
+        if user_id in self._batch_users:
+            await event.answer("⚠️ A batch download is already running. Please wait.", alert=True)
+            return
+        if self.active_downloads.get(user_id, 0) >= CONCURRENT_LIMITS[tier]:
+            await event.answer("⚠️ You have too many active downloads. Please wait.", alert=True)
+            return
+        
+        self._batch_users.add(user_id)
+        slots = 0
+        try:
+            await event.answer("Starting batch download...")
+            
+            stories = await self.downloader.fetch_stories(username)
+            user_data = await self.db.get_user(user_id)
+            # Downloads still running elsewhere count against today's quota
+            quota = DAILY_LIMITS[tier] - user_data.daily_downloads - self.active_downloads.get(user_id, 0)
+            if quota < len(stories):
+                stories = stories[:max(0, int(quota))]
+            
+            if not stories:
+                await event.reply("❌ No stories to download.")
+                return
+            
+            # Reserve the slots left under the plan's limit before the next await
+            slots = self._start_download(user_id, tier, len(stories))
+            if not slots:
+                await event.reply("⚠️ You have too many active downloads. Please wait.")
+                return
+            
+            progress_msg = await event.reply(f"⏳ Downloading {len(stories)} stories from @{username}...")
+            semaphore = asyncio.Semaphore(slots)
+            
+            async def download_one(story_id: int):
+                async with semaphore:
+                    try:
+                        return story_id, await self.downloader.download_story(user_id, username, story_id)
+                    except Exception as e:
+                        logging.error(f"Error downloading story #{story_id} from {username}: {e}")
+                        return story_id, None
+            
+            sent = 0
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    tasks = [tg.create_task(download_one(story_id)) for story_id, _ in stories]
+                    
+                    # Send files in the order they finish downloading
+                    for next_done in asyncio.as_completed(tasks):
+                        story_id, file_path = await next_done
+                        if not file_path:
+                            continue
+                        try:
+                            await self.bot.send_file(
+                                event.chat_id,
+                                file_path,
+                                caption=f"✅ Downloaded from @{username}\n📅 Story #{story_id}"
+                            )
+                            sent += 1
+                        except Exception as e:
+                            logging.error(f"Error sending story #{story_id} from {username}: {e}")
+                        finally:
+                            file_path.unlink(missing_ok=True)
+                
+                await progress_msg.edit(f"✅ Sent {sent}/{len(stories)} stories from @{username}.")
+            
+            except Exception as e:
+                await progress_msg.edit(f"❌ Error: {str(e)}")
+        
+        finally:
+            if slots:
+                self._finish_download(user_id, slots)
+            self._batch_users.discard(user_id)
+    
+    def _start_download(self, user_id: int, tier: SubscriptionTier, count: int = 1) -> int:
+        """Reserve up to `count` download slots within the tier's limit, returning how many were taken"""
+        count = min(count, CONCURRENT_LIMITS[tier] - self.active_downloads.get(user_id, 0))
+        if count <= 0:
+            return 0
+        self.active_downloads[user_id] += count
+        self.active_download_count += count
+        return count
+    
+    def _finish_download(self, user_id: int, count: int = 1):
+        self.active_downloads[user_id] -= count
+        self.active_download_count -= count
+        if not self.active_downloads[user_id]:
+            del self.active_downloads[user_id]
     
     async def update_progress(self, message, current, total):
         """Update download progress in message"""
         if total > 0:
-            progress = current / total
-            bar = UIManager.create_progress_bar(progress)
+            # Update message at most every few seconds, and when complete
+            now = time.monotonic()
+            if current != total and now - getattr(message, '_last_edit', 0.0) < Config.PROGRESS_EDIT_INTERVAL:
+                return
+            message._last_edit = now
             
-            # Update message every 10% or when complete
-            if progress == 1 or int(progress * 100) % 10 == 0:
-                try:
-                    await message.edit(f"⬇️ Downloading...\n{bar}")
-                except:
-                    pass
+            bar = UIManager.create_progress_bar(current / total)
+            try:
+                await message.edit(f"⬇️ Downloading...\n{bar}")
+            except (MessageNotModifiedError, FloodWaitError):
+                pass
     
     async def handle_callback(self, event):
         """Handle button callbacks"""
@@ -650,6 +1334,10 @@ class StoryBot:
             await event.answer("Starting download...")
             await self.download_single_story(event, username, int(story_id))
         
+        elif data.startswith("dl_all:"):
+            _, username = data.split(":")
+            await self.download_all_stories(event, username)
+        
         elif data == "upgrade":
             await self.show_upgrade_options(event)
         
@@ -677,13 +1365,7 @@ class StoryBot:
             await event.answer("Loading preview...")
             
             # Fetch the story
-            stories = await self.downloader.fetch_stories(username)
-            target_story = None
-            
-            for sid, story in stories:
-                if sid == story_id:
-                    target_story = story
-                    break
+            target_story = await self.downloader.get_story(username, story_id)
             
             if not target_story:
                 await event.answer("Story not found", alert=True)
@@ -710,34 +1392,6 @@ class StoryBot:
     
     async def show_upgrade_options(self, event):
         """Show subscription upgrade options"""
-        text = """
-💎 **Subscription Plans**
-
-🆓 **FREE TIER**
-• 5 downloads per day
-• Basic speed
-• Single downloads only
-• No alerts
-
-⭐ **PREMIUM TIER** - $9.99/month
-• 50 downloads per day
-• High speed
-• Batch downloads (up to 5)
-• Story alerts
-• Priority support
-
-👑 **ULTRA TIER** - $19.99/month
-• Unlimited downloads
-• Maximum speed
-• One-click download all
-• Unlimited concurrent
-• Full alerts system
-• Best quality
-• No restrictions
-
-To upgrade, contact @admin with your preferred plan.
-        """
-        
         buttons = [
             [Button.inline("🆓 Free Features", b"free_info"),
              Button.inline("⭐ Premium Features", b"premium_info")],
@@ -746,7 +1400,15 @@ To upgrade, contact @admin with your preferred plan.
             [Button.inline("📞 Contact Admin", b"contact_admin")]
         ]
         
-        await event.edit(text, buttons=buttons)
+        await event.edit(UPGRADE_TEXT, formatting_entities=UPGRADE_ENTITIES, buttons=buttons)
+    
+    async def show_help(self, event):
+        """Show the help center"""
+        await event.edit(HELP_MAIN_TEXT, formatting_entities=HELP_MAIN_ENTITIES)
+    
+    async def show_premium_info(self, event):
+        """Show what the premium plan includes"""
+        await event.edit(PREMIUM_INFO_TEXT, formatting_entities=PREMIUM_INFO_ENTITIES, buttons=[[Button.inline("⭐ Upgrade Plan", b"upgrade")]])
     
     async def show_user_stats(self, event):
         """Show user statistics"""
@@ -757,32 +1419,21 @@ To upgrade, contact @admin with your preferred plan.
             return
         
         tier, ends = await self.sub_manager.check_subscription(event.sender_id)
+        daily_limit = '∞' if tier == SubscriptionTier.ULTRA else DAILY_LIMITS[tier]
         
         text = f"""
 📊 **Your Statistics**
 
 👤 User ID: `{user_data.user_id}`
 {self.ui.get_subscription_icon(tier)} Plan: **{tier.value.upper()}**
-📅 Plan ends: {ends.strftime('%Y-%m-%d') if ends else 'Never'}
+📅 Plan ends: {datetime.fromtimestamp(ends).strftime('%Y-%m-%d') if ends else 'Never'}
 
 📥 **Downloads:**
-• Today: {user_data.daily_downloads}/{{
-    SubscriptionTier.FREE: Config.FREE_DAILY_LIMIT,
-    SubscriptionTier.PREMIUM: Config.PREMIUM_DAILY_LIMIT,
-    SubscriptionTier.ULTRA: '∞'
-}}[tier]
+• Today: {user_data.daily_downloads}/{daily_limit}
 • Total: {user_data.total_downloads}
 
-⚡ **Speed:** {{
-    SubscriptionTier.FREE: 'Normal',
-    SubscriptionTier.PREMIUM: 'Fast',
-    SubscriptionTier.ULTRA: 'Ultra Fast'
-}}[tier]
-🔢 **Concurrent:** {{
-    SubscriptionTier.FREE: Config.FREE_CONCURRENT,
-    SubscriptionTier.PREMIUM: Config.PREMIUM_CONCURRENT,
-    SubscriptionTier.ULTRA: Config.ULTRA_CONCURRENT
-}}[tier]
+⚡ **Speed:** {SPEED_LABELS[tier]}
+🔢 **Concurrent:** {CONCURRENT_LIMITS[tier]}
 
 📈 **Followed Accounts:** {len(user_data.followed_accounts)}
         """
@@ -791,161 +1442,81 @@ To upgrade, contact @admin with your preferred plan.
     
     # ==================== ADMIN/DEVELOPER FEATURES ====================
     
+    @dev_only
     async def handle_panel(self, event):
         """Developer control panel"""
-        if event.sender_id not in Config.DEVELOPER_IDS:
-            await event.reply("❌ Access denied.")
-            return
-        
-        text = """
-🔧 **Developer Control Panel**
-
-Choose an option:
-        """
-        
-        buttons = [
-            [Button.inline("📊 System Stats", b"admin_stats"),
-             Button.inline("👥 Users", b"admin_users")],
-            [Button.inline("🔑 Generate Code", b"admin_gen_code"),
-             Button.inline("📋 Active Subs", b"admin_subs")],
-            [Button.inline("📡 Sessions", b"admin_sessions"),
-             Button.inline("📨 Broadcast", b"admin_broadcast")],
-            [Button.inline("📜 Logs", b"admin_logs"),
-             Button.inline("⚙️ Settings", b"admin_settings")]
-        ]
-        
-        await event.reply(text, buttons=buttons)
+        await event.reply(PANEL_TEXT, formatting_entities=PANEL_ENTITIES, buttons=PANEL_BUTTONS)
     
+    @dev_only
     async def handle_stats(self, event):
         """System statistics"""
-        if event.sender_id not in Config.DEVELOPER_IDS:
-            await event.reply("❌ Access denied.")
-            return
-        
-        # Load all users
-        users_data = await self.db.load_json(Config.USERS_DB)
-        
-        # Calculate statistics
-        total_users = len(users_data)
-        free_users = sum(1 for u in users_data.values() if u.get('subscription_tier') == 'free')
-        premium_users = sum(1 for u in users_data.values() if u.get('subscription_tier') == 'premium')
-        ultra_users = sum(1 for u in users_data.values() if u.get('subscription_tier') == 'ultra')
-        
-        total_downloads = sum(int(u.get('total_downloads', 0)) for u in users_data.values())
+        stats = self.stats
         
         text = f"""
 📈 **System Statistics**
 
 👥 **Users:**
-• Total: {total_users}
-• Free: {free_users}
-• Premium: {premium_users}
-• Ultra: {ultra_users}
+• Total: {stats['total_users']}
+• Free: {stats['free']}
+• Premium: {stats['premium']}
+• Ultra: {stats['ultra']}
 
 📥 **Downloads:**
-• Total: {total_downloads}
-• Today: {sum(1 for u in users_data.values() if datetime.fromisoformat(u.get('last_reset')).date() == datetime.now().date())}
+• Total: {stats['total_downloads']}
+• Today: {stats['today_downloads']}
 
 🖥️ **System:**
 • Active sessions: {len(self.session_manager.active_sessions)}
-• Active downloads: {sum(len(v) for v in self.active_downloads.values())}
+• Active downloads: {self.active_download_count}
 • Cache size: {len(self.downloader.cache)} items
 
 💾 **Database:**
-• Users: {total_users} records
-• Codes: {len(await self.db.load_json(Config.CODES_DB))}
-• Logs: {len(await self.db.load_json(Config.LOGS_DB))}
+• Users: {stats['total_users']} records
+• Codes: {await self.db.count_codes()}
+• Logs: {await self.db.count_json(Config.LOGS_DB)}
         """
         
         await event.reply(text)
     
     async def handle_help(self, event):
         """Help command with distributed sections"""
-        args = event.text.split()[1:] if len(event.text.split()) > 1 else []
-        
-        if not args:
-            text = """
-🆘 **Help Center**
-
-Choose a help section:
-/help bot - What the bot does
-/help systems - Free/Premium/Ultra systems
-/help subscription - How subscriptions work
-/help alerts - How alerts work
-/help download - How to download stories
-/help commands - All available commands
-
-Or use buttons below:
-            """
-            buttons = [
-                [Button.inline("🤖 Bot Info", b"help_bot"),
-                 Button.inline("⭐ Systems", b"help_systems")],
-                [Button.inline("💎 Subscription", b"help_subscription"),
-                 Button.inline("🔔 Alerts", b"help_alerts")],
-                [Button.inline("📥 Download", b"help_download"),
-                 Button.inline("📋 Commands", b"help_commands")]
-            ]
-            await event.reply(text, buttons=buttons)
-        
-        elif args[0] == "bot":
-            await event.reply("""
-🤖 **StoryDownloader Pro**
-
-A powerful Telegram bot for downloading stories from public Telegram accounts.
-
-**Features:**
-• Download stories as photos/videos
-• Preview before download
-• Multiple quality options
-• Subscription system
-• Story alerts
-• Developer dashboard
-• And much more!
-
-**Privacy:**
-• We don't store your downloaded files
-• We respect Telegram's ToS
-• All downloads are client-side
-            """)
-        
-        # ... (other help sections)
+        parts = event.text.split(maxsplit=1)
+        args = parts[1].split() if len(parts) > 1 else []
+        
+        section = HELP_SECTIONS.get(args[0]) if args else None
+        if section:
+            text, entities = section
+            await event.reply(text, formatting_entities=entities)
+        else:
+            await event.reply(HELP_MAIN_TEXT, formatting_entities=HELP_MAIN_ENTITIES, buttons=HELP_MAIN_BUTTONS)
 
 # ==================== SCHEDULED TASKS ====================
 async def scheduled_tasks(bot: StoryBot):
     """Run scheduled tasks"""
-    # Reset daily downloads
-    users_data = await bot.db.load_json(Config.USERS_DB)
-    for user_id, user_data in users_data.items():
-        last_reset = datetime.fromisoformat(user_data.get('last_reset'))
-        if (datetime.now() - last_reset).days >= 1:
-            user_data['daily_downloads'] = 0
-            user_data['last_reset'] = datetime.now().isoformat()
-    await bot.db.save_json(Config.USERS_DB, users_data)
-    
-    # Check for expired subscriptions
-    for user_id, user_data in users_data.items():
-        if user_data.get('subscription_ends'):
-            ends = datetime.fromisoformat(user_data['subscription_ends'])
-            if datetime.now() > ends:
-                user_data['subscription_tier'] = 'free'
-                user_data['subscription_ends'] = None
-                # Notify user
-                try:
-                    await bot.bot.send_message(
-                        int(user_id),
-                        "⚠️ Your subscription has expired. You've been downgraded to Free tier."
-                    )
-                except:
-                    pass
+    now = int(time.time())
     
-    # Save updated users
-    await bot.db.save_json(Config.USERS_DB, users_data)
+    # Reset daily downloads and downgrade expired subscriptions
+    await bot.db.reset_daily_downloads(now)
+    expired = await bot.db.expire_subscriptions(now)
+    await bot.db.load_stats()
+    
+    # Notify users whose subscription expired, a bounded number at a time
+    semaphore = asyncio.Semaphore(Config.NOTIFY_CONCURRENCY)
+    
+    async def notify(user_id: int):
+        async with semaphore:
+            await bot.bot.send_message(
+                user_id,
+                "⚠️ Your subscription has expired. You've been downgraded to Free tier."
+            )
+    
+    results = await asyncio.gather(*(notify(user_id) for user_id in expired), return_exceptions=True)
+    for user_id, result in zip(expired, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Failed to notify {user_id} about expired subscription: {result}")
     
     # Clean old cache
-    bot.downloader.cache = {
-        k: v for k, v in bot.downloader.cache.items()
-        if datetime.now() - v['timestamp'] < Config.CACHE_DURATION
-    }
+    bot.downloader.prune_cache(datetime.now())
 
 # ==================== MAIN ENTRY POINT ====================
 async def main():
@@ -958,6 +1529,8 @@ async def main():
     
     # Initialize bot
     bot = StoryBot()
+    await bot.db.connect()
+    await bot.db.load_stats()
     
     # Start scheduler
     scheduler = AsyncIOScheduler()
@@ -971,17 +1544,23 @@ async def main():
     # Start the bot
     await bot.bot.start(bot_token=Config.BOT_TOKEN)
     
-    # Load existing sessions
+    # Load existing sessions, connecting them all at once
     sessions_data = await bot.db.load_json(Config.SESSIONS_DB)
-    for name, session_string in sessions_data.items():
-        await bot.session_manager.add_session(session_string, name)
+    await asyncio.gather(
+        *(bot.session_manager.add_session(session_string, name)
+          for name, session_string in sessions_data.items()),
+        return_exceptions=True
+    )
     
     print("🚀 StoryDownloader Pro is running!")
     print(f"🤖 Bot: @{(await bot.bot.get_me()).username}")
     print(f"🔧 Active sessions: {len(bot.session_manager.active_sessions)}")
     
     # Run until disconnected
-    await bot.bot.run_until_disconnected()
+    try:
+        await bot.bot.run_until_disconnected()
+    finally:
+        await bot.close()
 
 if __name__ == "__main__":
     # Create necessary directories